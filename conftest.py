@@ -0,0 +1,9 @@
+import pytest
+
+from loader import get_graph
+
+
+@pytest.fixture(scope="session", autouse=True)
+def graph():
+    """Load the FIBO graph once, before the first test, and share it."""
+    return get_graph()
@@ -3,6 +3,12 @@
 # LRU cache size for SPARQL queries
 SPARQL_CACHE_SIZE = 1000
 
+# LRU cache size for compacted URIs (results repeat the same URIs heavily)
+URI_CACHE_SIZE = 16384
+
+# LRU cache size for BM25 search results
+SEARCH_CACHE_SIZE = 512
+
 # Standard RDF/OWL namespace prefixes
 PREFIXES = {
     "http://www.w3.org/1999/02/22-rdf-syntax-ns#": "rdf:",
@@ -1,13 +1,18 @@
-import hashlib
+import json
 import logging
 import re
+import threading
+from collections import Counter
 from functools import lru_cache
-from typing import Any
+from itertools import islice
+from typing import Any, Callable, Iterator
 
+from rdflib import OWL, RDF, RDFS, SKOS, XSD, Graph, Literal, URIRef
+from rdflib.term import Node
 from toon_format import encode
 
-from constants import PREFIXES, SPARQL_CACHE_SIZE
-from loader import get_graph
+from constants import PREFIXES, SEARCH_CACHE_SIZE, SPARQL_CACHE_SIZE, URI_CACHE_SIZE
+from loader import get_graph, graph_source
 
 logger = logging.getLogger(__name__)
 
@@ -15,116 +20,482 @@ logger = logging.getLogger(__name__)
 BM25_TOP_K = 10
 
 
+# Longest namespace first, so a nested namespace wins over its parent
+_PREFIX_RE = re.compile(
+    "|".join(re.escape(full) for full in sorted(PREFIXES, key=len, reverse=True))
+)
+
+
+@lru_cache(maxsize=URI_CACHE_SIZE)
 def _compact_uri(uri: str) -> str:
-    for full, prefix in PREFIXES.items():
-        if uri.startswith(full):
-            return prefix + uri[len(full) :]
-    return uri
+    match = _PREFIX_RE.match(uri)
+    return PREFIXES[match.group()] + uri[match.end() :] if match else uri
 
 
-def _compact_result(row: dict[str, str]) -> dict[str, str]:
-    return {k: _compact_uri(v) for k, v in row.items()}
+def _compact_result(row: dict[str, Node]) -> dict[str, str]:
+    # Only IRIs get prefixed; a literal that happens to start with one stays as is
+    return {
+        k: _compact_uri(str(v)) if isinstance(v, URIRef) else str(v)
+        for k, v in row.items()
+    }
 
 
 _bm25_index = None
 _docs_data = None
+_bm25_lock = threading.Lock()
 
 
-def _get_bm25():
+def _tokenize(texts: list[str]):
+    """Tokenize for BM25; the corpus and queries must share this pipeline."""
+    import bm25s
+    import Stemmer
+
+    # Stemmer objects are not thread-safe, and building one is cheap
+    stemmer = Stemmer.Stemmer("english")
+    return bm25s.tokenize(
+        texts, stopwords="en", stemmer=stemmer.stemWords, show_progress=False
+    )
+
+
+def _build_bm25() -> None:
     global _bm25_index, _docs_data
+    import bm25s
+
+    graph = get_graph()
+    source = graph_source()
+    index_dir = source.with_suffix(".bm25")
+    # docs.json is written last, so its mtime marks a complete index
+    docs_path = index_dir / "docs.json"
+    if (
+        source.exists()
+        and docs_path.exists()
+        and docs_path.stat().st_mtime >= source.stat().st_mtime
+    ):
+        try:
+            logger.info("Loading BM25 index from %s...", index_dir)
+            docs = json.loads(docs_path.read_text())
+            _docs_data = {"uri": docs["uri"], "label": docs["label"]}
+            _bm25_index = bm25s.BM25.load(index_dir, show_progress=False)
+            return
+        except Exception as e:
+            logger.warning("Could not load BM25 index, rebuilding: %s", e)
+
+    # Column layout: hits index straight into these, with URIs compacted once here
+    _docs_data = {"uri": [], "label": []}
+    corpus_texts = []
+    for c in graph.subjects(RDF.type, OWL.Class, unique=True):
+        uri = _compact_uri(str(c))
+        definition = graph.value(c, SKOS.definition)
+        defn = str(definition) if definition is not None else ""
+        for label in map(str, graph.objects(c, RDFS.label)):
+            _docs_data["uri"].append(uri)
+            _docs_data["label"].append(label)
+            corpus_texts.append(f"{label} {defn}".lower())
+    retriever = bm25s.BM25()
+    retriever.index(_tokenize(corpus_texts), show_progress=False)
+
+    if source.exists():
+        logger.info("Saving BM25 index to %s...", index_dir)
+        try:
+            retriever.save(index_dir, show_progress=False)
+            docs_path.write_text(json.dumps(_docs_data))
+        except OSError as e:
+            logger.warning("Could not save BM25 index: %s", e)
+    _bm25_index = retriever
+
+
+def _get_bm25():
     if _bm25_index is None:
-        from rank_bm25 import BM25Okapi
-
-        graph = get_graph()
-        results = graph.query("""
-            SELECT ?c ?label ?def WHERE {
-                ?c a <http://www.w3.org/2002/07/owl#Class> .
-                ?c <http://www.w3.org/2000/01/rdf-schema#label> ?label .
-                OPTIONAL { ?c <http://www.w3.org/2004/02/skos/core#definition> ?def }
-            }
-        """)
-        _docs_data = []
-        corpus = []
-        for r in results:
-            uri, label = str(r.c), str(r.label)  # type: ignore
-            defn = str(r["def"]) if r["def"] else ""  # type: ignore
-            _docs_data.append({"uri": uri, "label": label, "definition": defn})
-            corpus.append(f"{label} {defn}".lower().split())
-        _bm25_index = BM25Okapi(corpus)
+        # main.py builds the index in a background thread; callers that
+        # arrive mid-build wait here instead of building a second copy
+        with _bm25_lock:
+            if _bm25_index is None:
+                _build_bm25()
     return _bm25_index, _docs_data
 
 
-def _extract_search_term(query: str) -> str | None:
-    patterns = [
+# Tried in order: a CONTAINS over LCASE(?x) beats one over STR(?x), which beats
+# one over a bare variable, wherever each appears in the query
+_SEARCH_TERM_RES = tuple(
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in (
         r'CONTAINS\s*\(\s*LCASE\s*\(\s*\?\w+\s*\)\s*,\s*["\']([^"\']+)["\']',
         r'CONTAINS\s*\(\s*STR\s*\(\s*\?\w+\s*\)\s*,\s*["\']([^"\']+)["\']',
         r'CONTAINS\s*\(\s*\?\w+\s*,\s*["\']([^"\']+)["\']',
         r'=\s*["\']([^"\']+)["\']',
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, query, re.IGNORECASE)
+    )
+)
+
+
+def _extract_search_term(query: str) -> str | None:
+    for pattern in _SEARCH_TERM_RES:
+        match = pattern.search(query)
         if match:
             return match.group(1).lower()
     return None
 
 
+@lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def _cached_fuzzy_search(term: str, top_k: int) -> tuple[dict[str, Any], ...]:
+    """Rank classes against a lowercased term (cached by term and top_k)."""
+    retriever, docs = _get_bm25()
+    uris, labels = docs["uri"], docs["label"]
+    doc_ids, scores = retriever.retrieve(
+        _tokenize([term]),
+        k=min(top_k, len(uris)),
+        show_progress=False,
+    )
+    return tuple(
+        {"uri": uris[i], "label": labels[i], "score": round(float(score), 2)}
+        for i, score in zip(doc_ids[0], scores[0])
+        if score > 0
+    )
+
+
 def fuzzy_search(term: str, top_k: int = BM25_TOP_K) -> list[dict[str, Any]]:
-    bm25, docs = _get_bm25()
-    scores = bm25.get_scores(term.lower().split())
-    top_idx = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k]
-    return [
-        {
-            "uri": _compact_uri(docs[i]["uri"]),
-            "label": docs[i]["label"],
-            "score": round(scores[i], 2),
-        }
-        for i in top_idx
-        if scores[i] > 0
-    ]
+    # Copy each row so callers can't mutate the cached entry
+    return [dict(row) for row in _cached_fuzzy_search(term.lower(), top_k)]
+
+
+# An IRI, comment or string literal (group 1, kept verbatim), or a run of
+# whitespace outside one. IRIs and comments come first, so a quote inside them
+# cannot open a string.
+_QUERY_SPACE_RE = re.compile(
+    r'(<[^<>"{}|^`\\\s]*>|#[^\n]*'
+    r'|"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')|\s+'
+)
+
+
+def _normalize_query(query: str) -> str:
+    """Collapse layout-only whitespace so reformatted queries share a cache entry.
+
+    Runs containing a newline become a single newline, so '#' comments still end
+    where they did.
+    """
+    return _QUERY_SPACE_RE.sub(
+        lambda m: m.group(1) or ("\n" if "\n" in m.group() else " "), query
+    ).strip()
+
+
+# Building blocks for recognising common query shapes that can be answered
+# straight from rdflib's triple indexes, without parsing or algebra evaluation
+_PROLOGUE = r"\s*(?:(?i:PREFIX)\s+[\w.-]*:\s*<[^<>\s]*>\s*)*"
+_SELECT = r"(?i:SELECT)\s+"
+_WHERE = r"\s+(?i:WHERE)?\s*\{\s*"
+_END = r"\s*\.?\s*\}\s*"
+_SUBCLASS_OF = (
+    r"(?:rdfs:subClassOf|<http://www\.w3\.org/2000/01/rdf-schema#subClassOf>)"
+)
+_LABEL = r"(?:rdfs:label|<http://www\.w3\.org/2000/01/rdf-schema#label>)"
+_DEFINITION = (
+    r"(?:skos:definition|<http://www\.w3\.org/2004/02/skos/core#definition>)"
+)
+_TYPE = r"(?:a|rdf:type|<http://www\.w3\.org/1999/02/22-rdf-syntax-ns#type>)"
+_LIMIT = r"(?:(?i:LIMIT)\s+(\d+)\s*)?"
+# An IRI or prefixed name, resolved by _resolve_term
+_TERM = r"(<[^<>\"\s]+>|(?:[A-Za-z][\w-]*)?:[\w-]+)"
+# A triple-pattern position: a variable, or a term ("a" only as predicate)
+_NODE = r"(\?\w+|" + _TERM[1:]
+_PREDICATE = r"(a|\?\w+|" + _TERM[1:]
+_PREFIX_DECL_RE = re.compile(r"(?i:PREFIX)\s+([\w.-]*):\s*<([^<>\s]*)>")
+_STANDARD_NS = {"rdf": str(RDF), "rdfs": str(RDFS), "skos": str(SKOS)}
+
+# Any single triple pattern, e.g. SELECT ?p ?o WHERE { <uri> ?p ?o },
+# SELECT ?child WHERE { ?child rdfs:subClassOf <uri> } or
+# SELECT ?label WHERE { ?s rdfs:label ?label } LIMIT 5
+_TRIPLE_RE = re.compile(
+    _PROLOGUE
+    + _SELECT
+    + r"((?:\?\w+\s+)*\?\w+)"
+    + _WHERE
+    + _NODE
+    + r"\s+"
+    + _PREDICATE
+    + r"\s+"
+    + _NODE
+    + _END
+    + _LIMIT
+)
+# The Define template from the tool docstring, FILTER before or after OPTIONAL:
+# SELECT ?c ?label ?def WHERE { ?c rdfs:label ?label .
+#   FILTER(CONTAINS(LCASE(?label), "term")) OPTIONAL { ?c skos:definition ?def } }
+_LABEL_FILTER = (
+    r'(?i:FILTER)\s*\(\s*(?i:CONTAINS)\s*\(\s*(?i:LCASE)\s*\(\s*\?\2\s*\)'
+    r'\s*,\s*"([^"\\\n]*)"\s*\)\s*\)'
+)
+_DEFINITION_OPTIONAL = (
+    r"(?i:OPTIONAL)\s*\{\s*\?\1\s+" + _DEFINITION + r"\s+\?\3\s*\.?\s*\}"
+)
+_DEFINE_RE = re.compile(
+    _PROLOGUE
+    + _SELECT
+    + r"\?(\w+)\s+\?(\w+)\s+\?(\w+)"
+    + _WHERE
+    + r"\?\1\s+"
+    + _LABEL
+    + r"\s+\?\2\s*\.?\s*(?:"
+    + _LABEL_FILTER
+    + r"\s*\.?\s*"
+    + _DEFINITION_OPTIONAL
+    + r"|"
+    + _DEFINITION_OPTIONAL
+    + r"\s*\.?\s*"
+    + _LABEL_FILTER
+    + r")"
+    + _END
+    + _LIMIT
+)
+
+
+# SELECT ?sub WHERE { ?sub rdfs:subClassOf+ owl:Thing }
+_DESCENDANTS_RE = re.compile(
+    _PROLOGUE
+    + _SELECT
+    + r"\?(\w+)"
+    + _WHERE
+    + r"\?\1\s+"
+    + _SUBCLASS_OF
+    + r"\+\s+"
+    + _TERM
+    + _END
+    + _LIMIT
+)
+# SELECT ?ancestor WHERE { <uri> rdfs:subClassOf+ ?ancestor }
+_ANCESTORS_RE = re.compile(
+    _PROLOGUE
+    + _SELECT
+    + r"\?(\w+)"
+    + _WHERE
+    + _TERM
+    + r"\s+"
+    + _SUBCLASS_OF
+    + r"\+\s+\?\1"
+    + _END
+    + _LIMIT
+)
+
+# SELECT (COUNT(?x) AS ?total) WHERE { ?x a owl:Class }, also COUNT(*)/DISTINCT
+_COUNT_RE = re.compile(
+    _PROLOGUE
+    + _SELECT
+    + r"\(\s*(?i:COUNT)\s*\(\s*(?:(?i:DISTINCT)\s+)?(?:\*|\?(\w+))\s*\)"
+    + r"\s+(?i:AS)\s+\?(\w+)\s*\)"
+    + _WHERE
+    + r"\?(\w+)\s+"
+    + _TYPE
+    + r"\s+"
+    + _TERM
+    + _END
+)
+
+
+def _resolve_term(graph: Graph, query: str, term: str) -> URIRef | None:
+    """Expand an IRI or prefixed name the way graph.query would, else None."""
+    if term.startswith("<"):
+        return URIRef(term[1:-1])
+    prefix, local = term.split(":", 1)
+    # Prefixes declared in the query win over the graph's own bindings
+    declared = dict(_PREFIX_DECL_RE.findall(query))
+    if prefix in declared:
+        namespace = declared[prefix]
+    else:
+        namespace = graph.namespace_manager.store.namespace(prefix)
+    return URIRef(namespace + local) if namespace is not None else None
+
+
+def _transitive(step: Callable[[Node], Iterator[Node]], start: Node) -> Iterator[Node]:
+    """Nodes reachable from start in one or more steps.
+
+    Depth-first and in the order rdflib's own path evaluation yields them, so a
+    LIMIT picks the same rows; iterative, so deep hierarchies nest no generators.
+    """
+    done = set()
+    expanded = {start}
+    stack = [step(start)]
+    while stack:
+        for node in stack[-1]:
+            if node not in done:
+                done.add(node)
+                yield node
+            if node not in expanded:
+                expanded.add(node)
+                stack.append(step(node))
+                break
+        else:
+            stack.pop()
+
+
+def _triple(graph: Graph, match: re.Match) -> list[dict[str, str]] | None:
+    select, *nodes, limit = match.groups()
+    projected = [name[1:] for name in select.split()]
+    pattern: list[Node | None] = []
+    positions = {}
+    for i, node in enumerate(nodes):
+        if node.startswith("?"):
+            # A repeated variable is a join the index lookup cannot express
+            if node[1:] in positions:
+                return None
+            positions[node[1:]] = i
+            pattern.append(None)
+        else:
+            term = RDF.type if node == "a" else _resolve_term(graph, match.string, node)
+            if term is None:
+                return None
+            pattern.append(term)
+    if len(set(projected)) < len(projected) or not positions.keys() >= set(projected):
+        return None
+    # rdflib evaluates a one-pattern BGP with this same triples() call, so the
+    # rows, their order and any LIMIT cut all match the engine
+    rows = (
+        _compact_result({name: triple[positions[name]] for name in projected})
+        for triple in graph.triples(tuple(pattern))
+    )
+    return list(islice(rows, int(limit))) if limit else list(rows)
+
+
+@lru_cache(maxsize=1)
+def _label_index(graph: Graph) -> tuple[tuple[Node, Literal, str], ...]:
+    """(subject, label, lowercased label) for every string-valued rdfs:label.
+
+    Kept in triple order, so a LIMIT picks the same rows the engine would.
+    Labels that LCASE() rejects (IRIs, typed non-string literals) are left out.
+    """
+    return tuple(
+        (s, label, label.lower())
+        for s, label in graph.subject_objects(RDFS.label)
+        if isinstance(label, Literal) and label.datatype in (None, XSD.string)
+    )
+
+
+def _define(graph: Graph, match: re.Match) -> list[dict[str, str]] | None:
+    c, label, definition, term, term_after, limit = match.groups()
+    if len({c, label, definition}) < 3:
+        return None
+    needle = term if term is not None else term_after
+    # OPTIONAL: one row per definition, or a single row without ?def
+    rows = (
+        _compact_result(
+            {c: s, label: text} if d is None else {c: s, label: text, definition: d}
+        )
+        for s, text, lowered in _label_index(graph)
+        if needle in lowered
+        for d in list(graph.objects(s, SKOS.definition)) or [None]
+    )
+    return list(islice(rows, int(limit))) if limit else list(rows)
+
+
+def _descendants(graph: Graph, match: re.Match) -> list[dict[str, str]] | None:
+    var, term, limit = match.groups()
+    target = _resolve_term(graph, match.string, term)
+    if target is None:
+        return None
+    rows = (
+        _compact_result({var: node})
+        for node in _transitive(lambda n: graph.subjects(RDFS.subClassOf, n), target)
+    )
+    return list(islice(rows, int(limit))) if limit else list(rows)
+
+
+def _ancestors(graph: Graph, match: re.Match) -> list[dict[str, str]] | None:
+    var, term, limit = match.groups()
+    source = _resolve_term(graph, match.string, term)
+    if source is None:
+        return None
+    rows = (
+        _compact_result({var: node})
+        for node in _transitive(lambda n: graph.objects(n, RDFS.subClassOf), source)
+    )
+    return list(islice(rows, int(limit))) if limit else list(rows)
+
+
+@lru_cache(maxsize=1)
+def _type_counts(graph: Graph) -> Counter:
+    """Number of rdf:type triples per class, counted in one pass."""
+    return Counter(graph.objects(None, RDF.type))
+
+
+def _count_instances(graph: Graph, match: re.Match) -> list[dict[str, str]] | None:
+    counted, total, var, term = match.groups()
+    if counted not in (None, var) or total == var:
+        return None
+    target = _resolve_term(graph, match.string, term)
+    if target is None:
+        return None
+    # One solution per (?x, rdf:type, C) triple, and the store holds no duplicates,
+    # so COUNT, COUNT(*) and COUNT(DISTINCT) all equal the subject count
+    return [_compact_result({total: Literal(_type_counts(graph)[target])})]
+
+
+_SHAPES = [
+    (_TRIPLE_RE, _triple),
+    (_DEFINE_RE, _define),
+    (_DESCENDANTS_RE, _descendants),
+    (_ANCESTORS_RE, _ancestors),
+    (_COUNT_RE, _count_instances),
+]
+
+
+def _run_shape(graph: Graph, query: str) -> list[dict[str, str]] | None:
+    """Answer a recognised query shape from the triple indexes, else None."""
+    for prefix, namespace in _PREFIX_DECL_RE.findall(query):
+        if _STANDARD_NS.get(prefix, namespace) != namespace:
+            return None
+    for pattern, runner in _SHAPES:
+        match = pattern.fullmatch(query)
+        if match:
+            return runner(graph, match)
+    return None
+
+
+# Every SPARQL query has one of these forms; text without any cannot parse
+_QUERY_FORM_RE = re.compile(r"\b(?:SELECT|ASK|CONSTRUCT|DESCRIBE)\b", re.IGNORECASE)
 
 
 @lru_cache(maxsize=SPARQL_CACHE_SIZE)
-def _cached_sparql(query_hash: str, query: str) -> list[dict[str, str]]:
-    """Execute SPARQL and return results (cached by query hash)."""
+def _cached_sparql(query: str) -> list[dict[str, str]]:
+    """Execute SPARQL and return results (cached by query text)."""
+    if not _QUERY_FORM_RE.search(query):
+        raise ValueError(
+            "Not a SPARQL query: expected SELECT, ASK, CONSTRUCT or DESCRIBE"
+        )
     graph = get_graph()
+    output = _run_shape(graph, query)
+    if output is not None:
+        return output
+
     results = graph.query(query)
-    output = []
-    for row in results:
-        output.append(
-            _compact_result(
-                {
-                    str(var): str(row[var])
-                    for var in results.vars
-                    if row[var] is not None
-                }
-            )
+    # Rows are tuples in results.vars order, so pair them positionally
+    names = [str(var) for var in results.vars]
+    return [
+        _compact_result(
+            {name: value for name, value in zip(names, row) if value is not None}
         )
-    return output
+        for row in results
+    ]
 
 
 def sparql(query: str) -> str:
     logger.info(
-        f"Executing SPARQL query: {query[:80]}{'...' if len(query) > 80 else ''}"
+        "Executing SPARQL query: %s%s", query[:80], "..." if len(query) > 80 else ""
     )
 
     try:
-        query_hash = hashlib.sha256(query.encode()).hexdigest()
-        output = _cached_sparql(query_hash, query)
+        output = _cached_sparql(_normalize_query(query))
 
-        logger.info(f"SPARQL query returned {len(output)} results.")
+        logger.info("SPARQL query returned %d results.", len(output))
         result: dict[str, Any] = {"results": output, "count": len(output)}
 
         term = _extract_search_term(query)
         if term:
             result["suggestions"] = fuzzy_search(term)
             logger.info(
-                f"Added {len(result['suggestions'])} BM25 suggestions for '{term}'"
+                "Added %d BM25 suggestions for '%s'", len(result["suggestions"]), term
             )
 
         return encode(result)
 
     except Exception as e:
-        logger.error(f"SPARQL query failed: {e}")
+        logger.error("SPARQL query failed: %s", e)
         return encode({"error": str(e)})
 
 
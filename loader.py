@@ -1,8 +1,12 @@
+import os
 import sys
+import pickle
 import re
 import logging
-import subprocess
 import shutil
+import tarfile
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from rdflib import Graph
@@ -19,10 +23,36 @@ def _fix_dates(ttl: str) -> str:
     )
 
 
+def _write_turtle(graph: Graph, path: Path) -> None:
+    """Serialize to turtle with zero-padded dates, so loads need no fix-up pass."""
+    graph.serialize(path, format="turtle")
+    _normalize_dates(path)
+
+
+def _file_stamp(path: Path) -> str:
+    stat = path.stat()
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def _normalize_dates(path: Path) -> None:
+    """Run _fix_dates over a turtle file once; a stamp sidecar marks it as done."""
+    stamp = path.with_suffix(".norm")
+    if stamp.exists() and stamp.read_text() == _file_stamp(path):
+        return
+    # This may be the only copy of the data, so never leave it half-written
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(_fix_dates(path.read_text(encoding="utf-8")), encoding="utf-8")
+    os.replace(tmp, path)
+    stamp.write_text(_file_stamp(path))
+
+
 # --- Configuration ---
 DATA_DIR = Path(__file__).parent / "data"
 STORE_PATH = DATA_DIR / "fibo.ttl"
 MATERIALIZED_PATH = DATA_DIR / "fibo_materialized.ttl"
+FIBO_ARCHIVE_URL = "https://github.com/edmcouncil/fibo/archive/refs/heads/master.tar.gz"
+# Below this many files, a process pool costs more than it saves
+PARALLEL_PARSE_MIN_FILES = 32
 
 
 _graph: Graph | None = None
@@ -48,39 +78,88 @@ def get_graph(force_download: bool = False, materialize: bool = False) -> Graph:
 
     if force_download:
         logger.info("Force download requested. Removing cached data...")
-        STORE_PATH.unlink(missing_ok=True)
-        MATERIALIZED_PATH.unlink(missing_ok=True)
+        for path in (STORE_PATH, MATERIALIZED_PATH):
+            path.unlink(missing_ok=True)
+            path.with_suffix(".pickle").unlink(missing_ok=True)
         _graph = None
         _materialized = False
 
     # Try loading pre-materialized graph first (fast path)
     if materialize and MATERIALIZED_PATH.exists():
-        logger.info(f"Loading pre-materialized graph from {MATERIALIZED_PATH}...")
-        _graph = Graph()
-        content = _fix_dates(MATERIALIZED_PATH.read_text())
-        _graph.parse(data=content, format="turtle")
+        logger.info("Loading pre-materialized graph from %s...", MATERIALIZED_PATH)
+        _graph = _load_turtle(MATERIALIZED_PATH)
         _materialized = True
-        logger.info(f"Materialized graph loaded with {len(_graph)} triples.")
+        logger.info("Materialized graph loaded with %d triples.", len(_graph))
         return _graph
 
     if STORE_PATH.exists():
-        logger.info(f"Loading graph from {STORE_PATH}...")
-        _graph = Graph()
-        content = _fix_dates(STORE_PATH.read_text())
-        _graph.parse(data=content, format="turtle")
-        logger.info(f"Graph loaded with {len(_graph)} triples.")
+        logger.info("Loading graph from %s...", STORE_PATH)
+        _graph = _load_turtle(STORE_PATH)
+        logger.info("Graph loaded with %d triples.", len(_graph))
         if materialize:
             _materialize_graph(_graph)
         return _graph
 
     # Download and build graph
-    logger.info(f"{STORE_PATH} not found. Starting download process.")
+    logger.info("%s not found. Starting download process.", STORE_PATH)
     _graph = _download_and_build()
     if materialize:
         _materialize_graph(_graph)
     return _graph
 
 
+def graph_source() -> Path:
+    """Return the turtle cache that backs the currently loaded graph."""
+    return MATERIALIZED_PATH if _materialized else STORE_PATH
+
+
+def _share_terms(graph: Graph) -> Graph:
+    """Copy graph so that equal terms are one shared object.
+
+    The parser creates a new term object per occurrence. Sharing them cuts
+    resident memory, and pickle stores each shared term once, which roughly
+    halves the snapshot.
+    """
+    pool: dict = {}
+    shared = Graph(bind_namespaces="none")
+    for prefix, namespace in graph.namespaces():
+        shared.bind(prefix, namespace)
+    for triple in graph:
+        shared.add(tuple(pool.setdefault(term, term) for term in triple))
+    return shared
+
+
+def _load_turtle(path: Path) -> Graph:
+    """Load a turtle cache, preferring its pickled snapshot when up to date."""
+    snapshot = path.with_suffix(".pickle")
+    if snapshot.exists() and snapshot.stat().st_mtime >= path.stat().st_mtime:
+        try:
+            with snapshot.open("rb") as f:
+                return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logger.warning("Could not load graph snapshot, reparsing: %s", e)
+
+    try:
+        _normalize_dates(path)
+        graph = Graph().parse(path, format="turtle")
+    except OSError as e:
+        logger.warning("Could not normalize %s, fixing dates in memory: %s", path, e)
+        content = _fix_dates(path.read_text(encoding="utf-8"))
+        graph = Graph().parse(data=content, format="turtle")
+    graph = _share_terms(graph)
+
+    # Unpickling skips turtle lexing entirely on subsequent startups
+    logger.info("Writing graph snapshot to %s...", snapshot)
+    tmp = snapshot.with_name(snapshot.name + ".tmp")
+    try:
+        with tmp.open("wb") as f:
+            pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, snapshot)
+    except OSError as e:
+        logger.warning("Could not write graph snapshot: %s", e)
+    return graph
+
+
 def _materialize_graph(graph: Graph) -> None:
     """Expand graph with OWL-RL inferences and cache to disk."""
     global _materialized
@@ -92,58 +171,94 @@ def _materialize_graph(graph: Graph) -> None:
     DeductiveClosure(OWLRL_Semantics).expand(graph)
     after = len(graph)
     _materialized = True
-    logger.info(f"Graph expanded from {before} to {after} triples (+{after - before} inferred)")
+    logger.info("Graph expanded from %d to %d triples (+%d inferred)", before, after, after - before)
 
     # Cache materialized graph for fast subsequent loads
-    logger.info(f"Caching materialized graph to {MATERIALIZED_PATH}...")
-    graph.serialize(MATERIALIZED_PATH, format="turtle")
+    logger.info("Caching materialized graph to %s...", MATERIALIZED_PATH)
+    _write_turtle(graph, MATERIALIZED_PATH)
     logger.info("Materialized graph cached.")
 
 
+def _parse_to_nt(path: Path) -> tuple[str, list[tuple[str, str]]]:
+    """Parse one RDF/XML file into N-Triples plus the prefixes it declares."""
+    graph = Graph(bind_namespaces="none")
+    try:
+        graph.parse(path, format="xml")
+    except Exception as e:
+        logger.warning("Could not parse %s: %s", path.name, e)
+        return "", []
+    namespaces = [(prefix, str(ns)) for prefix, ns in graph.namespaces()]
+    return graph.serialize(format="nt"), namespaces
+
+
+def _parse_files(files: list[Path]) -> Graph:
+    """Merge RDF/XML files into one graph, parsing them in worker processes."""
+    graph = Graph()
+    if len(files) < PARALLEL_PARSE_MIN_FILES or (os.cpu_count() or 1) < 2:
+        for i, f in enumerate(files, 1):
+            if i % 50 == 0:
+                logger.info("Processing file %d/%d...", i, len(files))
+            try:
+                graph.parse(f, format="xml")
+            except Exception as e:
+                logger.warning("Could not parse %s: %s", f.name, e)
+        return graph
+
+    with ProcessPoolExecutor() as executor:
+        parsed = executor.map(_parse_to_nt, files, chunksize=8)
+        for i, (nt, namespaces) in enumerate(parsed, 1):
+            if i % 50 == 0:
+                logger.info("Processing file %d/%d...", i, len(files))
+            graph.parse(data=nt, format="nt")
+            for prefix, ns in namespaces:
+                graph.bind(prefix, ns, override=False)
+    return graph
+
+
+def _extract_rdf(url: str, dest: Path) -> None:
+    """Stream a tar.gz archive and write out only its RDF/OWL files under dest."""
+    with urllib.request.urlopen(url) as response, tarfile.open(
+        fileobj=response, mode="r|gz"
+    ) as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith((".rdf", ".owl")):
+                continue
+            # Drop the archive's top-level "fibo-<branch>/" directory
+            parts = Path(member.name).parts[1:]
+            if not parts or ".." in parts or Path(member.name).is_absolute():
+                continue
+            target = dest.joinpath(*parts)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with archive.extractfile(member) as src, open(target, "wb") as out:
+                shutil.copyfileobj(src, out)
+
+
 def _download_and_build() -> Graph:
     """Download FIBO repository and build graph from RDF/OWL files."""
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     FIBO_DIR = DATA_DIR / "fibo"
 
     if FIBO_DIR.exists():
-        logger.info(f"Removing existing FIBO directory at {FIBO_DIR}")
+        logger.info("Removing existing FIBO directory at %s", FIBO_DIR)
         shutil.rmtree(FIBO_DIR)
 
-    logger.info("Cloning FIBO repository... (This may take a few minutes)")
+    logger.info("Downloading FIBO archive... (This may take a few minutes)")
     try:
-        subprocess.run(
-            [
-                "git",
-                "clone",
-                "--depth=1",
-                "https://github.com/edmcouncil/fibo.git",
-                str(FIBO_DIR),
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to clone FIBO: {e.stderr}")
+        _extract_rdf(FIBO_ARCHIVE_URL, FIBO_DIR)
+    except (OSError, tarfile.TarError) as e:
+        logger.error("Failed to download FIBO: %s", e)
         sys.exit(1)
 
     logger.info("Loading all RDF/OWL files into graph...")
-    graph = Graph()
     files = list(FIBO_DIR.rglob("*.rdf")) + list(FIBO_DIR.rglob("*.owl"))
 
-    logger.info(f"Found {len(files)} RDF/OWL files to process")
-    for i, f in enumerate(files, 1):
-        if i % 50 == 0:
-            logger.info(f"Processing file {i}/{len(files)}...")
-        try:
-            graph.parse(f, format="xml")
-        except Exception as e:
-            logger.warning(f"Could not parse {f.name}: {e}")
+    logger.info("Found %d RDF/OWL files to process", len(files))
+    graph = _parse_files(files)
 
     logger.info(
-        f"Graph loaded with {len(graph)} triples. Serializing to {STORE_PATH}..."
+        "Graph loaded with %d triples. Serializing to %s...", len(graph), STORE_PATH
     )
-    graph.serialize(STORE_PATH, format="turtle")
+    _write_turtle(graph, STORE_PATH)
 
     logger.info("Cleaning up downloaded files...")
     shutil.rmtree(FIBO_DIR)
@@ -1,5 +1,6 @@
 import logging
 import argparse
+import threading
 
 from fastmcp import FastMCP
 
@@ -12,12 +13,21 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] - %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
+# The format above never shows thread or process info, so skip collecting it
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 logger = logging.getLogger(__name__)
 
 
 mcp = FastMCP("FIBO")
 
 
+def _warm_search_index() -> None:
+    fibo._get_bm25()
+    logger.info("BM25 search index ready.")
+
+
 @mcp.tool()
 def sparql(query: str) -> str:
     """Query FIBO - the financial industry ontology used by major banks and regulators.
@@ -111,13 +121,13 @@ if __name__ == "__main__":
     if not args.materialize:
         logger.info("Tip: Use --materialize for OWL-RL inference (expands 130K→616K triples, cached after first run)")
 
-    logger.info("Pre-building BM25 search index...")
-    fibo._get_bm25()
+    logger.info("Building BM25 search index in the background...")
+    threading.Thread(target=_warm_search_index, daemon=True).start()
 
     logger.info("Initialization complete. Ready to serve queries.")
 
     if args.http:
-        logger.info(f"Starting HTTP server on port {args.port}...")
+        logger.info("Starting HTTP server on port %d...", args.port)
         mcp.run(transport="http", port=args.port)
     else:
         logger.info("Starting FIBO MCP server in stdio mode...")
@@ -1,5 +1,6 @@
+import pytest
+
 import fibo
-from loader import get_graph
 
 
 def test_sparql_basic_query():
@@ -73,7 +74,50 @@ def test_sparql_prefix_compression():
     assert "rdfs:" in result or "owl:" in result or "fibo:" in result
 
 
-def test_graph_initialization():
-    g = get_graph()
-    assert g is not None
-    assert len(g) > 0
+def test_normalize_query_keeps_literals():
+    # A quote inside an IRI or a comment must not open a string literal
+    assert "'a  b'" in fibo._normalize_query("SELECT ?x WHERE { <http://x/it's> ?p 'a  b' }")
+    commented = fibo._normalize_query('SELECT ?x WHERE { # a """ in comment\n ?x ?p "a  b" . ?x ?q """x   y""" }')
+    assert '"a  b"' in commented and '"""x   y"""' in commented
+
+    query = """
+    SELECT ?label WHERE {
+        ?s rdfs:label ?label .
+    } LIMIT 5
+    """
+    reindented = """SELECT  ?label  WHERE  {
+\t?s   rdfs:label ?label .
+} LIMIT 5"""
+    assert fibo._normalize_query(query) == fibo._normalize_query(reindented)
+
+
+def test_graph_initialization(graph):
+    assert graph is not None
+    assert len(graph) > 0
+
+
+SOVEREIGN_STATE = "https://spec.edmcouncil.org/fibo/ontology/BE/GovernmentEntities/GovernmentEntities/SovereignState"
+
+
+# %s takes FILTER(true), which keeps the query off the shortcut path
+@pytest.mark.parametrize(
+    "query, ordered",
+    [
+        ("SELECT ?p ?v WHERE { <" + SOVEREIGN_STATE + "> ?p ?v %s }", False),
+        ('SELECT ?c ?label ?def WHERE { ?c rdfs:label ?label . FILTER(CONTAINS(LCASE(?label), "sovereign")) OPTIONAL { ?c skos:definition ?def } %s }', False),
+        # LIMIT must keep the rows the engine would have kept, in its order
+        ("SELECT ?s WHERE { ?s rdfs:subClassOf+ owl:Thing %s } LIMIT 10", True),
+        ("SELECT ?a WHERE { <" + SOVEREIGN_STATE + "> rdfs:subClassOf+ ?a %s }", True),
+        ("SELECT (COUNT(?c) AS ?total) WHERE { ?c a owl:Class %s }", True),
+    ],
+    ids=["triple", "define", "descendants", "ancestors", "count"],
+)
+def test_shortcut_matches_engine(graph, query, ordered):
+    assert fibo._run_shape(graph, query % "") is not None
+    shortcut = fibo._cached_sparql(query % "")
+    engine = fibo._cached_sparql(query % "FILTER(true)")
+    assert len(shortcut) > 0
+    if ordered:
+        assert shortcut == engine
+    else:
+        assert sorted(shortcut, key=repr) == sorted(engine, key=repr)